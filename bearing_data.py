@@ -0,0 +1,994 @@
+"""Data access and inference.
+
+Part of Bearing Vibration Prediction Information System.
+
+Functions in this module do not depend on wx, so they can be reused
+outside of the GUI.
+"""
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Tuple
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+import bisect
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+import joblib
+from psycopg2 import extensions
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BEARING_LIST: List[str] = ['Первый подшипник',
+                           'Второй подшипник',
+                           'Третий подшипник']
+BEARING_TABLES: Dict[int, str] = {0: 'X1', 1: 'X2', 2: 'X3'}
+BEARING_COLUMN_COUNTS: Dict[int, int] = {0: 16, 1: 18, 2: 18}
+SCALER_PATHS: Dict[int, str] = {0: r'scalers\scaler1st.model',
+                                1: r'scalers\scaler2st.model',
+                                2: r'scalers\scaler3st.model'}
+MODEL_PATHS: Dict[int, str] = {0: r'models\final_model_1st.model',
+                               1: r'models\final_model_2st.model',
+                               2: r'models\final_model_3st.model'}
+DATA_INTERVAL: timedelta = timedelta(minutes=10)
+# raw features keep database precision, scaled features may be float32
+RAW_DTYPE = np.float64
+# working memory of a forecast, bigger ranges are processed in chunks
+MEMORY_BUDGET_MB: int = int(os.environ.get('BEARING_MEMORY_BUDGET_MB', 256))
+# predictions of float32 and float64 input must agree to use float32
+FLOAT32_RTOL: float = 1e-6
+FLOAT32_CHECK_ROWS: int = 1000
+RSS_SAMPLE_INTERVAL: float = 0.05
+# ranges with more rows are predicted by ShardedPredictor (~half a year)
+SHARDED_INFERENCE_ROWS: int = 25000
+# shards per worker process, more shards balance uneven workers
+SHARDS_PER_PROCESS: int = 4
+# prefetched predictions older than this are fetched again
+PREFETCH_TTL: timedelta = DATA_INTERVAL
+PREFETCH_CACHE_SIZE: int = 8
+# prefetch checks for cancellation after every chunk of predictions
+PREFETCH_CHUNK_ROWS: int = 1000
+
+# models loaded in ShardedPredictor worker process, by model path
+_worker_models: Dict[str, Any] = {}
+# scaled feature dtype of bearings whose model has been checked
+_feature_dtypes: Dict[int, Any] = {}
+
+logger = logging.getLogger(__name__)
+
+
+def get_columns(bearing: int) -> List[str]:
+    """Get predictor matrix column names.
+
+    Args:
+        bearing (int): Bearing type.
+
+    Returns:
+        List[str]: Feature column names without date column.
+    """
+    return ['col ' + str(i)
+            for i in range(1, BEARING_COLUMN_COUNTS[bearing])]
+
+
+def get_chunk_rows(column_count: int) -> int:
+    """Get number of rows that fit into memory budget.
+
+    Fetched rows are tuples of Python objects, so every cell costs
+    about 32 bytes instead of 8 bytes in float64 matrix.
+
+    Args:
+        column_count (int): Number of columns in row.
+
+    Returns:
+        int: Number of rows.
+    """
+    row_size: int = 64 + 32 * column_count
+    return max(1, MEMORY_BUDGET_MB * 2**20 // row_size)
+
+
+def fits_memory_budget(bearing: int,
+                       date_begin: datetime,
+                       date_end: datetime) -> bool:
+    """Check whether whole predictor matrix of date range fits into budget.
+
+    Raw and scaled matrices are alive at the same time while scaling.
+
+    Args:
+        bearing (int): Bearing type.
+        date_begin (datetime.datetime): First prediction date.
+        date_end (datetime.datetime): Second prediction date.
+
+    Returns:
+        bool: True if matrix fits into MEMORY_BUDGET_MB.
+    """
+    max_rows: int = int((date_end - date_begin) / DATA_INTERVAL)
+    row_size: int = 8 + 2 * np.dtype(RAW_DTYPE).itemsize * (
+        BEARING_COLUMN_COUNTS[bearing] - 1)
+    return max_rows * row_size <= MEMORY_BUDGET_MB * 2**20
+
+
+def iter_predictor_chunks(connection,
+                          bearing: int,
+                          date_begin: datetime,
+                          date_end: datetime):
+    """Fetch bearing data for date range chunk by chunk.
+
+    If the range does not fit into MEMORY_BUDGET_MB it is read through
+    server-side cursor, so only one chunk of rows is kept in memory.
+
+    Args:
+        connection: PostgreSQL connection.
+        bearing (int): Bearing type.
+        date_begin (datetime.datetime): First prediction date.
+        date_end (datetime.datetime): Second prediction date.
+
+    Yields:
+        pd.DataFrame: Unscaled rows with datetime64[ns] index.
+    """
+    column_count: int = BEARING_COLUMN_COUNTS[bearing]
+    max_rows: int = max(1, int((date_end - date_begin) / DATA_INTERVAL))
+    chunk_rows: int = min(max_rows, get_chunk_rows(column_count))
+    # named cursor keeps query result on server side
+    cursor_name = 'predictor_matrix' if chunk_rows < max_rows else None
+    query: str = f"SELECT * FROM {BEARING_TABLES[bearing]} \
+        WHERE date_time >= %s AND date_time < %s ORDER BY date_time"
+    with connection.cursor(name=cursor_name) as cursor:
+        cursor.execute(query, (date_begin, date_end))
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            dates = np.array([row[0] for row in rows],
+                             dtype='datetime64[ns]')
+            values = np.array([row[1:] for row in rows], dtype=RAW_DTYPE)
+            del rows
+            yield pd.DataFrame(data=values,
+                               index=pd.DatetimeIndex(dates,
+                                                      name='date_time'),
+                               columns=get_columns(bearing),
+                               copy=False)
+
+
+def fetch_predictor_matrix(connection,
+                           bearing: int,
+                           date_begin: datetime,
+                           date_end: datetime) -> pd.DataFrame:
+    """Fetch bearing data for date range.
+
+    Rows are copied into preallocated array with datetime64[ns] index
+    as soon as they are fetched. Use it only for ranges that pass
+    fits_memory_budget, bigger ones go through forecast_in_chunks.
+
+    Args:
+        connection: PostgreSQL connection.
+        bearing (int): Bearing type.
+        date_begin (datetime.datetime): First prediction date.
+        date_end (datetime.datetime): Second prediction date.
+
+    Returns:
+        pd.DataFrame: Unscaled predictor matrix, empty if there is no data.
+    """
+    feature_count: int = BEARING_COLUMN_COUNTS[bearing] - 1
+    max_rows: int = max(1, int((date_end - date_begin) / DATA_INTERVAL))
+    dates = np.empty(max_rows, dtype='datetime64[ns]')
+    values = np.empty((max_rows, feature_count), dtype=RAW_DTYPE)
+    row_count: int = 0
+    for chunk in iter_predictor_chunks(connection, bearing,
+                                       date_begin, date_end):
+        end: int = row_count + len(chunk)
+        if end > len(values):
+            # table has more rows than 10-minute slots in range
+            new_size: int = max(end, 2 * len(values))
+            dates.resize(new_size, refcheck=False)
+            values.resize((new_size, feature_count), refcheck=False)
+        dates[row_count:end] = chunk.index.to_numpy()
+        values[row_count:end] = chunk.to_numpy()
+        row_count = end
+        del chunk
+    dates.resize(row_count, refcheck=False)
+    values.resize((row_count, feature_count), refcheck=False)
+
+    return pd.DataFrame(data=values,
+                        index=pd.DatetimeIndex(dates, name='date_time'),
+                        columns=get_columns(bearing),
+                        copy=False)
+
+
+def get_feature_dtype(bearing: int):
+    """Get dtype of scaled features for bearing's model.
+
+    Args:
+        bearing (int): Bearing type.
+
+    Returns:
+        np.float32 if the model was checked to allow it, else np.float64.
+    """
+    return _feature_dtypes.get(bearing, np.float64)
+
+
+def check_feature_dtype(bearing: int,
+                        model,
+                        predictor_matrix: pd.DataFrame) -> None:
+    """Allow float32 features for model if predictions do not change.
+
+    Checked once per bearing on the first rows of scaled float64 matrix.
+
+    Args:
+        bearing (int): Bearing type.
+        model: Fitted model.
+        predictor_matrix (pd.DataFrame): Scaled float64 predictor matrix.
+    """
+    if bearing in _feature_dtypes or predictor_matrix.empty or \
+            predictor_matrix.dtypes.iloc[0] != np.float64:
+        return
+    sample = predictor_matrix.iloc[:FLOAT32_CHECK_ROWS]
+    allows_float32: bool = np.allclose(
+        model.predict(sample.astype(np.float32)),
+        model.predict(sample),
+        rtol=FLOAT32_RTOL, atol=0)
+    _feature_dtypes[bearing] = np.float32 if allows_float32 else np.float64
+    logger.info('Model of bearing %s uses %s features',
+                bearing, np.dtype(_feature_dtypes[bearing]).name)
+
+
+def scale_predictor_matrix(scaler,
+                           predictor_matrix: pd.DataFrame,
+                           dtype=np.float64) -> pd.DataFrame:
+    """Scale predictor matrix chunk by chunk.
+
+    Args:
+        scaler: Fitted scaler.
+        predictor_matrix (pd.DataFrame): Unscaled predictor matrix.
+        dtype: Dtype of scaled features, see get_feature_dtype.
+
+    Returns:
+        pd.DataFrame: Scaled predictor matrix.
+    """
+    values = np.empty(predictor_matrix.shape, dtype=dtype)
+    chunk_rows: int = get_chunk_rows(predictor_matrix.shape[1])
+    for begin in range(0, len(predictor_matrix), chunk_rows):
+        end: int = begin + chunk_rows
+        values[begin:end] = scaler.transform(
+            predictor_matrix.iloc[begin:end])
+    return pd.DataFrame(data=values,
+                        index=predictor_matrix.index,
+                        columns=predictor_matrix.columns,
+                        copy=False)
+
+
+def predict_values(model, predictor_matrix: pd.DataFrame) -> np.ndarray:
+    """Make predictions chunk by chunk.
+
+    Args:
+        model: Fitted model.
+        predictor_matrix (pd.DataFrame): Scaled predictor matrix.
+
+    Returns:
+        np.ndarray: Forecast values.
+    """
+    forecast_values = np.empty(len(predictor_matrix), dtype=np.float64)
+    chunk_rows: int = get_chunk_rows(predictor_matrix.shape[1])
+    for begin in range(0, len(predictor_matrix), chunk_rows):
+        end: int = begin + chunk_rows
+        forecast_values[begin:end] = model.predict(
+            predictor_matrix.iloc[begin:end])
+    return forecast_values
+
+
+def forecast_in_chunks(connection,
+                       bearing: int,
+                       date_begin: datetime,
+                       date_end: datetime,
+                       scaler,
+                       model):
+    """Fetch, scale and predict range that does not fit into memory budget.
+
+    Only one chunk of predictor matrix is alive at a time.
+
+    Args:
+        connection: PostgreSQL connection.
+        bearing (int): Bearing type.
+        date_begin (datetime.datetime): First prediction date.
+        date_end (datetime.datetime): Second prediction date.
+        scaler: Fitted scaler.
+        model: Fitted model.
+
+    Returns:
+        pd.DataFrame: Predictions, None if there is no data.
+    """
+    dates: List[np.ndarray] = []
+    forecast_values: List[np.ndarray] = []
+    for chunk in iter_predictor_chunks(connection, bearing,
+                                       date_begin, date_end):
+        dates.append(chunk.index.to_numpy())
+        chunk = scale_predictor_matrix(scaler, chunk,
+                                       get_feature_dtype(bearing))
+        check_feature_dtype(bearing, model, chunk)
+        forecast_values.append(predict_values(model, chunk))
+        del chunk
+    if not forecast_values:
+        return None
+    return make_predictions(pd.DatetimeIndex(np.concatenate(dates)),
+                            np.concatenate(forecast_values))
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    """Attach to shared memory created by another process.
+
+    Only the creating process should track the segment. Before 3.13
+    attaching registers it too, which is harmless while the worker
+    shares resource tracker with ShardedPredictor, see its __init__.
+
+    Args:
+        name (str): Shared memory name.
+
+    Returns:
+        shared_memory.SharedMemory: Attached shared memory.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    return shared_memory.SharedMemory(name=name)
+
+
+def _predict_shard(model_path: str,
+                   columns: List[str],
+                   dtype: str,
+                   input_name: str,
+                   output_name: str,
+                   shape: Tuple[int, int],
+                   begin: int,
+                   end: int) -> None:
+    """Predict rows of shared predictor matrix in worker process.
+
+    Args:
+        model_path (str): Path to model, loaded once per worker.
+        columns (List[str]): Feature column names.
+        dtype (str): Dtype of predictor matrix.
+        input_name (str): Shared memory name of predictor matrix.
+        output_name (str): Shared memory name of forecast values.
+        shape (Tuple[int, int]): Shape of predictor matrix.
+        begin (int): First row of shard.
+        end (int): Row after the last one of shard.
+    """
+    model = _worker_models.get(model_path)
+    if model is None:
+        model = _worker_models[model_path] = joblib.load(model_path)
+    input_memory = _attach_shared_memory(input_name)
+    output_memory = _attach_shared_memory(output_name)
+    values = np.ndarray(shape, dtype=dtype, buffer=input_memory.buf)
+    forecast_values = np.ndarray(shape[0],
+                                 dtype=np.float64,
+                                 buffer=output_memory.buf)
+    forecast_values[begin:end] = model.predict(
+        pd.DataFrame(values[begin:end], columns=columns, copy=False))
+    # views must be released before shared memory is closed
+    del values, forecast_values
+    input_memory.close()
+    output_memory.close()
+
+
+class ShardedPredictor:
+    """Pool of worker processes that predict shards of shared matrix."""
+
+    def __init__(self, processes: int = None):
+        """Create Sharded Predictor and start worker processes.
+
+        Args:
+            processes (int): Number of worker processes, CPU count if None.
+
+        Attributes:
+            processes (int): Number of worker processes.
+            pool (multiprocessing.pool.Pool): Persistent worker pool.
+        """
+        self.processes: int = processes or os.cpu_count() or 1
+        if os.name == 'posix':
+            # workers forked before resource tracker runs start their own
+            # one, which unlinks attached shared memory when they exit
+            resource_tracker.ensure_running()
+        self.pool = multiprocessing.Pool(self.processes)
+
+    def predict(self,
+                model_path: str,
+                predictor_matrix: pd.DataFrame) -> np.ndarray:
+        """Make predictions on all worker processes.
+
+        Predictor matrix is copied once into shared memory, workers get
+        only row ranges and write forecast values into preallocated
+        shared output array, so the matrix itself is never pickled.
+
+        Args:
+            model_path (str): Path to model.
+            predictor_matrix (pd.DataFrame): Scaled predictor matrix.
+
+        Returns:
+            np.ndarray: Forecast values.
+        """
+        shape: Tuple[int, int] = predictor_matrix.shape
+        dtype = predictor_matrix.dtypes.iloc[0]
+        input_memory = shared_memory.SharedMemory(
+            create=True, size=max(1, shape[0] * shape[1] * dtype.itemsize))
+        output_memory = shared_memory.SharedMemory(
+            create=True,
+            size=max(1, shape[0] * np.dtype(np.float64).itemsize))
+        try:
+            values = np.ndarray(shape, dtype=dtype, buffer=input_memory.buf)
+            values[:] = predictor_matrix.to_numpy(dtype=dtype)
+            del values
+
+            shard_count: int = max(
+                self.processes * SHARDS_PER_PROCESS,
+                -(-shape[0] // get_chunk_rows(shape[1])))
+            bounds = np.linspace(0, shape[0], shard_count + 1, dtype=int)
+            self.pool.starmap(
+                _predict_shard,
+                [(model_path, list(predictor_matrix.columns), dtype.name,
+                  input_memory.name, output_memory.name, shape,
+                  int(begin), int(end))
+                 for begin, end in zip(bounds[:-1], bounds[1:])
+                 if end > begin])
+
+            forecast_values = np.ndarray(shape[0],
+                                         dtype=np.float64,
+                                         buffer=output_memory.buf).copy()
+        finally:
+            input_memory.close()
+            input_memory.unlink()
+            output_memory.close()
+            output_memory.unlink()
+        return forecast_values
+
+    def close(self) -> None:
+        """Stop worker processes."""
+        self.pool.close()
+        self.pool.join()
+
+
+def prediction_intervals(y_r: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''Prediction interval'''
+    std = y_r.std()
+    koef = 2.1701
+    yr_min = y_r - round(koef * std, 8)
+    yr_max = y_r + round(koef * std, 8)
+    return yr_min, yr_max
+
+
+def make_predictions(dates: pd.DatetimeIndex,
+                     forecast_values: np.ndarray) -> pd.DataFrame:
+    """Make predictions DataFrame with confidence coridor.
+
+    Args:
+        dates (pd.DatetimeIndex): Dates of forecast values.
+        forecast_values (np.ndarray): Forecast values.
+
+    Returns:
+        pd.DataFrame: DataFrame that stores fitted values\
+            with confidence coridor.
+    """
+    forecast_values = forecast_values.astype(np.float64, copy=False)
+    min_forecast_values, max_forecast_values = prediction_intervals(
+        forecast_values)
+    return pd.DataFrame({'date': dates.to_numpy(),
+                         'value': forecast_values,
+                         'max_value': max_forecast_values,
+                         'min_value': min_forecast_values})
+
+
+def save_predictions(connection,
+                     bearing: int,
+                     predictions: pd.DataFrame) -> None:
+    """Save predictions to database.
+
+    Args:
+        connection: PostgreSQL connection.
+        bearing (int): Bearing type.
+        predictions (pd.DataFrame): DataFrame that stores fitted values\
+            with confidence coridor.
+    """
+    with connection.cursor() as cursor:
+        query: str = "CALL insert_predictions(%s, %s, %s);"
+        current_date = datetime.today()
+        report_date: str = current_date.strftime("%Y-%m-%d %H:%M:%S")
+        prediction = predictions.to_json(orient='records',
+                                         date_format='iso')
+        parametrs: List[Any] = [
+            BEARING_LIST[bearing], report_date, prediction]
+        cursor.execute(query, parametrs)
+        connection.commit()
+
+
+class CoverageIndex:
+    """Interval set of 10-minute slots that exist in bearing table."""
+
+    def __init__(self, bearing: int):
+        """Create empty Coverage Index.
+
+        Args:
+            bearing (int): Bearing type.
+
+        Attributes:
+            bearing (int): Bearing type.
+            begins (List[datetime.datetime]): First slots of intervals.
+            ends (List[datetime.datetime]): Last slots of intervals.
+            watermark (datetime.datetime): Last indexed date_time.
+        """
+        self.bearing = bearing
+        self.begins: List[datetime] = []
+        self.ends: List[datetime] = []
+        self.watermark = None
+
+    def update(self, connection) -> None:
+        """Add slots that appeared after watermark.
+
+        Rows inserted before watermark are added by refresh or add_dates.
+
+        Args:
+            connection: PostgreSQL connection.
+        """
+        self.merge(self.query_intervals(
+            connection, self.watermark or datetime.min, None))
+        if self.ends:
+            self.watermark = self.ends[-1]
+
+    def refresh(self,
+                connection,
+                date_begin: datetime,
+                date_end: datetime) -> None:
+        """Add slots of date range, including late and backfilled ones.
+
+        Args:
+            connection: PostgreSQL connection.
+            date_begin (datetime.datetime): First date of range.
+            date_end (datetime.datetime): Date after the last one of range.
+        """
+        self.merge(self.query_intervals(connection, date_begin, date_end))
+
+    def query_intervals(self,
+                        connection,
+                        date_begin: datetime,
+                        date_end) -> List[Tuple[datetime, datetime]]:
+        """Query intervals of consecutive slots.
+
+        Consecutive slots are grouped into intervals on server side,
+        so only interval bounds are transferred.
+
+        Args:
+            connection: PostgreSQL connection.
+            date_begin (datetime.datetime): Date before the first one\
+                of range, excluded unless date_end is given.
+            date_end (datetime.datetime): Date after the last one\
+                of range, None for no upper bound.
+
+        Returns:
+            List[Tuple[datetime.datetime, datetime.datetime]]:\
+                First and last slots of every interval.
+        """
+        if date_end is None:
+            condition: str = "date_time > %s"
+            parameters: Tuple = (DATA_INTERVAL, date_begin)
+        else:
+            condition = "date_time >= %s AND date_time < %s"
+            parameters = (DATA_INTERVAL, date_begin, date_end)
+        query: str = f"SELECT min(date_time), max(date_time) FROM \
+            (SELECT date_time, date_time - %s * row_number() \
+            OVER (ORDER BY date_time) AS island \
+            FROM {BEARING_TABLES[self.bearing]} \
+            WHERE {condition}) AS slots \
+            GROUP BY island ORDER BY 1"
+        with connection.cursor() as cursor:
+            cursor.execute(query, parameters)
+            intervals = cursor.fetchall()
+        connection.rollback()
+        return intervals
+
+    def add_dates(self, dates: pd.DatetimeIndex) -> None:
+        """Add slots of fetched rows.
+
+        Args:
+            dates (pd.DatetimeIndex): Sorted dates of fetched rows.
+        """
+        if dates.empty:
+            return
+        values = dates.to_numpy()
+        # new interval starts wherever the next slot is not adjacent
+        breaks = np.flatnonzero(np.diff(values) != np.timedelta64(
+            DATA_INTERVAL)) + 1
+        begins = np.concatenate(([0], breaks))
+        ends = np.concatenate((breaks - 1, [len(values) - 1]))
+        self.merge([(dates[begin].to_pydatetime(), dates[end].to_pydatetime())
+                    for begin, end in zip(begins, ends)])
+
+    def merge(self, intervals: List[Tuple[datetime, datetime]]) -> None:
+        """Merge intervals of slots into index.
+
+        Args:
+            intervals (List[Tuple[datetime.datetime, datetime.datetime]]):\
+                First and last slots of every interval.
+        """
+        if not intervals:
+            return
+        begins: List[datetime] = []
+        ends: List[datetime] = []
+        for begin, end in sorted(list(zip(self.begins, self.ends))
+                                 + list(intervals)):
+            if ends and begin <= ends[-1] + DATA_INTERVAL:
+                ends[-1] = max(ends[-1], end)
+            else:
+                begins.append(begin)
+                ends.append(end)
+        self.begins = begins
+        self.ends = ends
+
+    def count_slots(self, date_begin: datetime, date_end: datetime) -> int:
+        """Count existing slots in date range.
+
+        Args:
+            date_begin (datetime.datetime): First date of range.
+            date_end (datetime.datetime): Date after the last one of range.
+
+        Returns:
+            int: Number of existing 10-minute slots.
+        """
+        slot_count: int = 0
+        position: int = max(0, bisect.bisect_right(self.ends, date_begin) - 1)
+        for begin, end in zip(self.begins[position:], self.ends[position:]):
+            if begin >= date_end:
+                break
+            begin = max(begin, date_begin)
+            end = min(end + DATA_INTERVAL, date_end)
+            if end > begin:
+                slot_count += (end - begin) // DATA_INTERVAL
+        return slot_count
+
+    def get_gaps(self,
+                 date_begin: datetime,
+                 date_end: datetime) -> List[Tuple[datetime, datetime]]:
+        """Get missing ranges inside date range.
+
+        Args:
+            date_begin (datetime.datetime): First date of range.
+            date_end (datetime.datetime): Date after the last one of range.
+
+        Returns:
+            List[Tuple[datetime.datetime, datetime.datetime]]:\
+                First missing slot and date after the last missing slot\
+                of every gap.
+        """
+        gaps: List[Tuple[datetime, datetime]] = []
+        gap_begin: datetime = date_begin
+        position: int = max(0, bisect.bisect_right(self.ends, date_begin) - 1)
+        for begin, end in zip(self.begins[position:], self.ends[position:]):
+            if begin >= date_end:
+                break
+            if begin > gap_begin:
+                gaps.append((gap_begin, begin))
+            gap_begin = max(gap_begin, end + DATA_INTERVAL)
+        if gap_begin < date_end:
+            gaps.append((gap_begin, date_end))
+        return gaps
+
+
+class Prefetcher:
+    """Speculative background fetching and scoring of forecast ranges.
+
+    Ranges are identified by (bearing, date_begin, date_end) keys.
+    Work runs on one background thread, so connection pool must be
+    thread-safe. Only ranges shorter than SHARDED_INFERENCE_ROWS are
+    prefetched, bigger ones are left to ShardedPredictor.
+    """
+
+    def __init__(self, connection_pool):
+        """Create Prefetcher.
+
+        Args:
+            connection_pool (psycopg2.pool.ThreadedConnectionPool):\
+                PostgreSQL connection pool.
+
+        Attributes:
+            connection_pool (psycopg2.pool.ThreadedConnectionPool):\
+                PostgreSQL connection pool.
+            executor (ThreadPoolExecutor): Background thread.
+            lock (threading.Lock): Lock that guards attributes below.
+            results (Dict[Tuple, Tuple[float, pd.DataFrame]]):\
+                Prefetch time and predictions by range key.
+            futures (Dict[Tuple, Tuple[int, Future]]):\
+                Generation and future of pending work by range key,\
+                work stops once its entry is removed.
+            generation (int): Number that is increased by cancel.
+            connection: Connection of running query.
+            running_key (Tuple): Range key of running query.
+            models (Dict[str, Any]): Loaded scalers and models by path.
+            hits (int): Number of requests served from prefetch.
+            requests (int): Number of requests.
+        """
+        self.connection_pool = connection_pool
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.results: Dict[Tuple, Tuple[float, pd.DataFrame]] = {}
+        self.futures: Dict[Tuple, Tuple[int, Any]] = {}
+        self.generation: int = 0
+        self.connection = None
+        self.running_key = None
+        self.models: Dict[str, Any] = {}
+        self.hits: int = 0
+        self.requests: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        """float: Share of requests served from prefetch."""
+        return self.hits / self.requests if self.requests else 0.0
+
+    def prefetch_latest(self) -> None:
+        """Prefetch the latest 24 hours for every bearing."""
+        date_end = datetime.combine(date.today(), datetime.min.time())
+        date_begin = date_end - timedelta(days=1)
+        for bearing in BEARING_TABLES:
+            self.prefetch((bearing, date_begin, date_end))
+
+    def prefetch(self, key: Tuple, exclusive: bool = False) -> None:
+        """Start prefetch of range unless it is ready, pending or too big.
+
+        Args:
+            key (Tuple): Bearing, first and second prediction dates.
+            exclusive (bool): Cancel other prefetch work first.
+        """
+        bearing, date_begin, date_end = key
+        if (date_end - date_begin) / DATA_INTERVAL >= \
+                SHARDED_INFERENCE_ROWS or \
+                not fits_memory_budget(bearing, date_begin, date_end):
+            return
+        with self.lock:
+            if self.get_result(key) is not None or \
+                    self.get_future(key) is not None:
+                return
+        if exclusive:
+            self.cancel()
+        with self.lock:
+            self.futures[key] = (self.generation, self.executor.submit(
+                self.run, key, self.generation))
+
+    def get(self, key: Tuple):
+        """Get prefetched predictions and record hit or miss.
+
+        If the range is still being prefetched, work of other ranges
+        is cancelled and the range is awaited, as it is done sooner
+        than a new fetch. On a miss all prefetch work is cancelled,
+        as user has started a different request.
+
+        Args:
+            key (Tuple): Bearing, first and second prediction dates.
+
+        Returns:
+            pd.DataFrame: Predictions, None if range was not prefetched.
+        """
+        with self.lock:
+            self.requests += 1
+            predictions = self.get_result(key)
+            future = self.get_future(key)
+        if predictions is None and future is not None:
+            self.cancel(keep=key)
+            try:
+                future.result()
+            except CancelledError:
+                pass
+            with self.lock:
+                predictions = self.get_result(key)
+        if predictions is None:
+            self.cancel()
+        else:
+            with self.lock:
+                self.hits += 1
+        return predictions
+
+    def cancel(self, keep: Tuple = None) -> None:
+        """Cancel pending prefetch work and running query.
+
+        Work that has not started is removed from the queue, running
+        work stops after the current query or chunk of predictions.
+
+        Args:
+            keep (Tuple): Range key whose work goes on, None to cancel\
+                all work.
+        """
+        with self.lock:
+            self.generation += 1
+            for other_key in [other_key for other_key in self.futures
+                              if other_key != keep]:
+                self.futures.pop(other_key)[1].cancel()
+            if self.connection is not None and self.running_key != keep:
+                self.connection.cancel()
+
+    def close(self) -> None:
+        """Cancel prefetch work and stop background thread."""
+        self.cancel()
+        self.executor.shutdown(wait=True)
+
+    def get_result(self, key: Tuple):
+        """Get fresh predictions of range, call with lock held."""
+        result = self.results.get(key)
+        if result is not None and \
+                time.monotonic() - result[0] < PREFETCH_TTL.total_seconds():
+            return result[1]
+
+    def get_future(self, key: Tuple):
+        """Get pending future of range, call with lock held."""
+        pending = self.futures.get(key)
+        if pending is not None:
+            return pending[1]
+
+    def is_cancelled(self, key: Tuple, generation: int) -> bool:
+        """Check if work of range was cancelled.
+
+        Args:
+            key (Tuple): Bearing, first and second prediction dates.
+            generation (int): Generation the work belongs to.
+
+        Returns:
+            bool: True if work should stop.
+        """
+        with self.lock:
+            return self.futures.get(key, (None,))[0] != generation
+
+    def load(self, path: str):
+        """Load scaler or model once.
+
+        Args:
+            path (str): Path to scaler or model.
+
+        Returns:
+            Loaded scaler or model.
+        """
+        if path not in self.models:
+            self.models[path] = joblib.load(path)
+        return self.models[path]
+
+    def run(self, key: Tuple, generation: int) -> None:
+        """Fetch, scale and predict range on background thread.
+
+        Errors are logged and never reach the caller of get.
+
+        Args:
+            key (Tuple): Bearing, first and second prediction dates.
+            generation (int): Generation the work belongs to.
+        """
+        bearing, date_begin, date_end = key
+        try:
+            if self.is_cancelled(key, generation):
+                return
+            connection = self.connection_pool.getconn()
+            with self.lock:
+                self.connection = connection
+                self.running_key = key
+            try:
+                predictor_matrix = fetch_predictor_matrix(
+                    connection, bearing, date_begin, date_end)
+            except extensions.QueryCanceledError:
+                return
+            finally:
+                with self.lock:
+                    self.connection = None
+                    self.running_key = None
+                self.connection_pool.putconn(connection)
+            if predictor_matrix.empty or \
+                    self.is_cancelled(key, generation):
+                return
+
+            predictor_matrix = scale_predictor_matrix(
+                self.load(SCALER_PATHS[bearing]), predictor_matrix,
+                get_feature_dtype(bearing))
+            if self.is_cancelled(key, generation):
+                return
+            model = self.load(MODEL_PATHS[bearing])
+            check_feature_dtype(bearing, model, predictor_matrix)
+            forecast_values = np.empty(len(predictor_matrix),
+                                       dtype=np.float64)
+            for begin in range(0, len(predictor_matrix),
+                               PREFETCH_CHUNK_ROWS):
+                if self.is_cancelled(key, generation):
+                    return
+                end: int = begin + PREFETCH_CHUNK_ROWS
+                forecast_values[begin:end] = model.predict(
+                    predictor_matrix.iloc[begin:end])
+            predictions = make_predictions(predictor_matrix.index,
+                                           forecast_values)
+            with self.lock:
+                self.results[key] = (time.monotonic(), predictions)
+                while len(self.results) > PREFETCH_CACHE_SIZE:
+                    del self.results[next(iter(self.results))]
+        except Exception:
+            # failed range is a miss, request falls back to normal fetch
+            logger.exception('Prefetch of %s failed', key)
+        finally:
+            with self.lock:
+                if self.futures.get(key, (None,))[0] == generation:
+                    del self.futures[key]
+
+
+def get_current_rss() -> int:
+    """Get current resident set size of the process.
+
+    Returns:
+        int: RSS in bytes, 0 if the platform does not report it.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf(
+                'SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class RssMonitor:
+    """Context manager that samples RSS to find peak over blocks of code.
+
+    The same monitor may be entered several times, e.g. for fetch and
+    for prediction, then it reports peak over all of them.
+    """
+
+    def __init__(self, interval: float = RSS_SAMPLE_INTERVAL):
+        """Create RSS Monitor.
+
+        Args:
+            interval (float): Seconds between samples, shorter spikes\
+                may be missed.
+
+        Attributes:
+            interval (float): Seconds between samples.
+            start_rss (int): RSS in bytes when the first block started,\
+                None before that.
+            peak_rss (int): Highest sampled RSS in bytes.
+        """
+        self.interval = interval
+        self.start_rss = None
+        self.peak_rss: int = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        current_rss: int = get_current_rss()
+        if self.start_rss is None:
+            self.start_rss = current_rss
+        self.peak_rss = max(self.peak_rss, current_rss)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop_event.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, get_current_rss())
+
+    def sample(self) -> None:
+        """Sample RSS until block ends."""
+        while not self.stop_event.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, get_current_rss())
+
+
+def get_peak_rss() -> int:
+    """Get peak resident set size over process lifetime.
+
+    Returns:
+        int: Peak RSS in bytes, 0 if the platform does not report it.
+    """
+    if psutil is not None:
+        memory_info = psutil.Process().memory_info()
+        if hasattr(memory_info, 'peak_wset'):
+            return memory_info.peak_wset
+    if resource is not None:
+        peak_rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+    return 0
@@ -0,0 +1,543 @@
+"""Load test of bearing_db and inference path with concurrent analysts.
+
+Every simulated workstation is a separate process with its own
+connection pool, like one running GUI, and runs the same fetch, scale,
+predict and save functions as the GUI. By default a workstation has one
+analyst. With --analysts-per-workstation bigger than --pool-size analysts
+become threads that compete for pool connections, only then pool_wait
+shows contention. Data is synthetic and lives in a separate local
+PostgreSQL database prepared with --setup, never in bearing_db itself.
+
+Example:
+    createdb bearing_load_test
+    python load_test.py --user postgres --password postgres --setup
+    python load_test.py --user postgres --password postgres -n 1 2 4 8 16
+    python load_test.py --sharding-benchmark --synthetic-models
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import multiprocessing
+import os
+import random
+import threading
+import time
+import numpy as np
+import psycopg2 as pspg2
+from psycopg2 import pool
+import joblib
+import bearing_data
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DATA_BEGIN: datetime = datetime(2020, 1, 1)
+STAGES: List[str] = ['pool_wait', 'fetch', 'scale', 'predict', 'save',
+                     'total']
+SAMPLE_INTERVAL: float = 0.5
+# seconds to wait for workstations to load models and open connections
+SETUP_TIMEOUT: float = 600
+
+
+class BlockingConnectionPool(pool.ThreadedConnectionPool):
+    """Thread-safe pool whose getconn waits for a free connection.
+
+    ThreadedConnectionPool raises PoolError when it is exhausted,
+    so waiting time under contention could not be measured.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, *args, **kwargs):
+        """Create Blocking Connection Pool.
+
+        Args:
+            minconn (int): Number of connections opened at start.
+            maxconn (int): Maximum number of connections.
+        """
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self.semaphore = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self, key=None):
+        """Wait for free connection and get it."""
+        self.semaphore.acquire()
+        try:
+            return super().getconn(key)
+        except Exception:
+            self.semaphore.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False) -> None:
+        """Put connection back and wake up a waiting thread."""
+        super().putconn(conn, key, close)
+        self.semaphore.release()
+
+
+def get_connection_kwargs(args) -> Dict[str, Any]:
+    """Get connection arguments for psycopg2.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        Dict[str, Any]: Keyword arguments of psycopg2.connect.
+    """
+    return {'user': args.user,
+            'password': args.password,
+            'host': args.host,
+            'port': args.port,
+            'database': args.database}
+
+
+def setup_database(args) -> None:
+    """Fill database with synthetic X1/X2/X3 tables.
+
+    Also creates insert_predictions procedure that stores predictions
+    in predictions table. Existing tables are dropped only with --force.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+
+    Raises:
+        SystemExit: If tables already exist and --force is not given.
+    """
+    data_end: datetime = DATA_BEGIN + timedelta(days=args.data_days)
+    connection = pspg2.connect(**get_connection_kwargs(args))
+    with connection.cursor() as cursor:
+        tables: List[str] = list(bearing_data.BEARING_TABLES.values())
+        cursor.execute("SELECT tablename FROM pg_tables \
+            WHERE schemaname = current_schema() AND tablename = ANY(%s)",
+                       ([table.lower() for table in tables],))
+        existing_tables: List[str] = [row[0] for row in cursor.fetchall()]
+        if existing_tables and not args.force:
+            connection.close()
+            raise SystemExit(f'Tables {", ".join(existing_tables)} already '
+                             f'exist in {args.database}, use --force '
+                             f'to replace them.')
+        for bearing, table in bearing_data.BEARING_TABLES.items():
+            feature_count: int = bearing_data.BEARING_COLUMN_COUNTS[
+                bearing] - 1
+            columns: str = ', '.join(f'c{i} double precision'
+                                     for i in range(1, feature_count + 1))
+            values: str = ', '.join(
+                f'sin(extract(epoch FROM date_time) / {3600 * i}) '
+                f'+ random()' for i in range(1, feature_count + 1))
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+            cursor.execute(f"CREATE TABLE {table} \
+                (date_time timestamp PRIMARY KEY, {columns})")
+            cursor.execute(f"INSERT INTO {table} \
+                SELECT date_time, {values} FROM generate_series(\
+                %s::timestamp, %s::timestamp - interval '10 minutes', \
+                interval '10 minutes') AS date_time",
+                           (DATA_BEGIN, data_end))
+            cursor.execute(f"ANALYZE {table}")
+        cursor.execute("CREATE TABLE IF NOT EXISTS predictions \
+            (bearing text, report_date timestamp, prediction json)")
+        cursor.execute("CREATE OR REPLACE PROCEDURE insert_predictions(\
+            bearing text, report_date timestamp, prediction json) \
+            LANGUAGE SQL AS $$ INSERT INTO predictions \
+            VALUES (bearing, report_date, prediction) $$")
+    connection.commit()
+    connection.close()
+
+
+def load_model_file(path: str):
+    """Load model saved with joblib.
+
+    Args:
+        path (str): Path in Windows notation as in bearing_data.
+
+    Returns:
+        Loaded model or scaler.
+    """
+    return joblib.load(os.path.join(*path.split('\\')))
+
+
+def fit_synthetic_models(bearing: int):
+    """Fit scaler and model on random data of bearing's shape.
+
+    Used when real model files are not available, so that inference
+    still costs something close to a real model.
+
+    Args:
+        bearing (int): Bearing type.
+
+    Returns:
+        Tuple: Scaler and model.
+    """
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.preprocessing import StandardScaler
+    import pandas as pd
+
+    random_state = np.random.RandomState(bearing)
+    columns: List[str] = bearing_data.get_columns(bearing)
+    features = pd.DataFrame(random_state.rand(5000, len(columns)),
+                            columns=columns)
+    target = features.sum(axis=1) + random_state.rand(len(features))
+    scaler = StandardScaler().fit(features)
+    model = RandomForestRegressor(n_estimators=50,
+                                  max_depth=10,
+                                  random_state=bearing)
+    model.fit(pd.DataFrame(scaler.transform(features), columns=columns),
+              target)
+    return scaler, model
+
+
+def load_models(args) -> Dict[int, Any]:
+    """Load or fit scaler and model of every bearing.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+
+    Returns:
+        Dict[int, Any]: Scaler and model by bearing type.
+    """
+    models: Dict[int, Any] = {}
+    for bearing in bearing_data.BEARING_TABLES:
+        if args.synthetic_models:
+            models[bearing] = fit_synthetic_models(bearing)
+        else:
+            models[bearing] = (
+                load_model_file(bearing_data.SCALER_PATHS[bearing]),
+                load_model_file(bearing_data.MODEL_PATHS[bearing]))
+    return models
+
+
+def run_analyst(args,
+                analyst: int,
+                connection_pool: BlockingConnectionPool,
+                models: Dict[int, Any],
+                timings: List[Dict[str, float]]) -> None:
+    """Run forecasts of one simulated analyst.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        analyst (int): Analyst number, used as random seed.
+        connection_pool (BlockingConnectionPool):\
+            Connection pool of analyst's workstation.
+        models (Dict[int, Any]): Scaler and model by bearing type.
+        timings (List[Dict[str, float]]): List that receives duration\
+            of every stage in seconds for every forecast.
+    """
+    random_generator = random.Random(analyst)
+    for _ in range(args.requests):
+        bearing: int = random_generator.choice(
+            list(bearing_data.BEARING_TABLES))
+        first_day: int = random_generator.randrange(
+            args.data_days - args.range_days + 1)
+        date_begin: datetime = DATA_BEGIN + timedelta(days=first_day)
+        date_end: datetime = date_begin + timedelta(days=args.range_days)
+        scaler, model = models[bearing]
+        timing: Dict[str, float] = {}
+
+        # like the GUI, connection is held only for fetch and for save
+        start: float = time.perf_counter()
+        connection = connection_pool.getconn()
+        timing['pool_wait'] = time.perf_counter() - start
+        try:
+            stage_start: float = time.perf_counter()
+            predictor_matrix = bearing_data.fetch_predictor_matrix(
+                connection, bearing, date_begin, date_end)
+            connection.rollback()
+            timing['fetch'] = time.perf_counter() - stage_start
+        finally:
+            connection_pool.putconn(connection)
+
+        stage_start = time.perf_counter()
+        predictor_matrix = bearing_data.scale_predictor_matrix(
+            scaler, predictor_matrix,
+            bearing_data.get_feature_dtype(bearing))
+        timing['scale'] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        bearing_data.check_feature_dtype(bearing, model, predictor_matrix)
+        forecast_values = bearing_data.predict_values(
+            model, predictor_matrix)
+        predictions = bearing_data.make_predictions(
+            predictor_matrix.index, forecast_values)
+        del predictor_matrix
+        timing['predict'] = time.perf_counter() - stage_start
+
+        stage_start = time.perf_counter()
+        connection = connection_pool.getconn()
+        timing['pool_wait'] += time.perf_counter() - stage_start
+        try:
+            stage_start = time.perf_counter()
+            bearing_data.save_predictions(connection, bearing, predictions)
+            timing['save'] = time.perf_counter() - stage_start
+        finally:
+            connection_pool.putconn(connection)
+        timing['total'] = time.perf_counter() - start
+        timings.append(timing)
+
+
+def run_workstation(args,
+                    workstation: int,
+                    analyst_count: int,
+                    barrier) -> List[Dict[str, float]]:
+    """Run analysts of one simulated workstation on threads.
+
+    Models are prepared and pool connections are opened before the
+    barrier, so the measured time covers only forecasts. If preparation
+    fails, the barrier is aborted so that main process does not hang.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        workstation (int): Workstation number.
+        analyst_count (int): Number of analysts on workstation.
+        barrier: Barrier shared with other workstations and main process.
+
+    Returns:
+        List[Dict[str, float]]: Duration of every stage in seconds\
+            for every forecast.
+    """
+    try:
+        models: Dict[int, Any] = load_models(args)
+        # connect cost must not get into pool_wait
+        connection_pool = BlockingConnectionPool(
+            min(analyst_count, args.pool_size), args.pool_size,
+            **get_connection_kwargs(args))
+    except BaseException:
+        barrier.abort()
+        raise
+    timings: List[Dict[str, float]] = []
+    analysts: List[threading.Thread] = [
+        threading.Thread(target=run_analyst,
+                         args=(args,
+                               workstation * args.analysts_per_workstation
+                               + analyst,
+                               connection_pool, models, timings))
+        for analyst in range(analyst_count)]
+    barrier.wait(SETUP_TIMEOUT)
+    for analyst in analysts:
+        analyst.start()
+    for analyst in analysts:
+        analyst.join()
+    connection_pool.closeall()
+    return timings
+
+
+def monitor_server(args,
+                   stop_event: threading.Event,
+                   samples: List[Dict[str, float]]) -> None:
+    """Sample server load until stop event is set.
+
+    CPU of PostgreSQL backends is measured by their pids, so it is
+    separated from analysts that run on the same host. It is available
+    only if the server is local and psutil is installed.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        stop_event (threading.Event): Event that stops sampling.
+        samples (List[Dict[str, float]]): List that receives samples.
+    """
+    query: str = "SELECT count(*) FILTER (WHERE state = 'active'), \
+        count(*) FILTER (WHERE wait_event_type = 'Lock'), count(*), \
+        array_agg(pid) FROM pg_stat_activity \
+        WHERE datname = current_database() AND pid <> pg_backend_pid()"
+    connection = pspg2.connect(**get_connection_kwargs(args))
+    connection.autocommit = True
+    # cpu_percent compares with the previous call on the same object
+    backends: Dict[int, Any] = {}
+    if psutil is not None:
+        psutil.cpu_percent()
+    with connection.cursor() as cursor:
+        while not stop_event.wait(SAMPLE_INTERVAL):
+            cursor.execute(query)
+            active, lock_waiting, connections, pids = cursor.fetchone()
+            sample: Dict[str, float] = {'active': active,
+                                        'lock_waiting': lock_waiting,
+                                        'connections': connections}
+            if psutil is not None:
+                server_cpu: float = 0.0
+                for pid in pids or []:
+                    try:
+                        if pid not in backends:
+                            backends[pid] = psutil.Process(pid)
+                            backends[pid].cpu_percent()
+                        else:
+                            server_cpu += backends[pid].cpu_percent()
+                    except (psutil.NoSuchProcess, psutil.AccessDenied):
+                        backends.pop(pid, None)
+                if backends:
+                    sample['server_cpu'] = server_cpu
+                sample['host_cpu'] = psutil.cpu_percent()
+            samples.append(sample)
+    connection.close()
+
+
+def run_level(args, analyst_count: int) -> None:
+    """Run load test with given number of analysts and print report.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+        analyst_count (int): Number of concurrent analysts.
+    """
+    workstation_count: int = -(-analyst_count
+                               // args.analysts_per_workstation)
+    manager = multiprocessing.Manager()
+    barrier = manager.Barrier(workstation_count + 1)
+    samples: List[Dict[str, float]] = []
+    stop_event = threading.Event()
+    monitor = threading.Thread(target=monitor_server,
+                               args=(args, stop_event, samples))
+
+    with ProcessPoolExecutor(max_workers=workstation_count) as executor:
+        futures = []
+        for workstation in range(workstation_count):
+            first_analyst: int = workstation \
+                * args.analysts_per_workstation
+            futures.append(executor.submit(
+                run_workstation, args, workstation,
+                min(args.analysts_per_workstation,
+                    analyst_count - first_analyst),
+                barrier))
+        # start the clock when every workstation is ready
+        try:
+            barrier.wait(SETUP_TIMEOUT)
+        except threading.BrokenBarrierError:
+            # every workstation stops at the broken barrier,
+            # show the error of the one that broke it
+            errors = [future.exception() for future in futures]
+            for error in errors:
+                if error is not None and not isinstance(
+                        error, threading.BrokenBarrierError):
+                    raise error
+            raise
+        monitor.start()
+        start: float = time.perf_counter()
+        timings: List[Dict[str, float]] = [
+            timing for future in futures for timing in future.result()]
+        duration: float = time.perf_counter() - start
+    manager.shutdown()
+
+    stop_event.set()
+    monitor.join()
+
+    print(f'analysts: {analyst_count}, workstations: {workstation_count}, '
+          f'forecasts: {len(timings)}, '
+          f'throughput: {len(timings) / duration:.2f} forecasts/s')
+    for stage in STAGES:
+        durations = np.array([timing[stage] for timing in timings]) * 1000
+        p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+        print(f'  {stage:<10} p50 {p50:9.1f} ms  p95 {p95:9.1f} ms  '
+              f'p99 {p99:9.1f} ms')
+    if samples:
+        for key in ['active', 'lock_waiting', 'connections',
+                    'server_cpu', 'host_cpu']:
+            values = [sample[key] for sample in samples if key in sample]
+            if values:
+                print(f'  {key:<14} mean {np.mean(values):7.1f}  '
+                      f'max {np.max(values):7.1f}')
+
+
+def run_sharding_benchmark(args) -> None:
+    """Time sharded inference with different numbers of processes.
+
+    Predictions on a random scaled matrix are made once in the current
+    process and then by ShardedPredictor, speed-up is relative to the
+    single worker process. Needs no database.
+
+    Args:
+        args (argparse.Namespace): Command line arguments.
+    """
+    import tempfile
+    import pandas as pd
+
+    bearing: int = 0
+    if args.synthetic_models:
+        scaler, model = fit_synthetic_models(bearing)
+    else:
+        scaler = load_model_file(bearing_data.SCALER_PATHS[bearing])
+        model = load_model_file(bearing_data.MODEL_PATHS[bearing])
+    columns: List[str] = bearing_data.get_columns(bearing)
+    random_state = np.random.RandomState(bearing)
+    predictor_matrix = bearing_data.scale_predictor_matrix(
+        scaler,
+        pd.DataFrame(random_state.rand(args.benchmark_rows, len(columns)),
+                     columns=columns))
+
+    start: float = time.perf_counter()
+    expected = bearing_data.predict_values(model, predictor_matrix)
+    duration: float = time.perf_counter() - start
+    print(f'rows: {len(predictor_matrix)}, cpus: {os.cpu_count()}')
+    print(f'  in-process    {duration:7.2f} s')
+
+    with tempfile.TemporaryDirectory() as directory:
+        # workers load the model by path
+        model_path: str = os.path.join(directory, 'model.joblib')
+        joblib.dump(model, model_path)
+        single_duration: float = None
+        for processes in args.benchmark_processes:
+            predictor = bearing_data.ShardedPredictor(processes)
+            try:
+                # first call loads the model in every worker
+                predictor.predict(model_path, predictor_matrix)
+                start = time.perf_counter()
+                forecast_values = predictor.predict(model_path,
+                                                    predictor_matrix)
+                duration = time.perf_counter() - start
+            finally:
+                predictor.close()
+            if not np.allclose(forecast_values, expected):
+                raise RuntimeError(f'{processes} processes predicted '
+                                   f'other values than in-process')
+            if single_duration is None:
+                single_duration = duration
+            print(f'  processes {processes:<3} {duration:7.2f} s  '
+                  f'speed-up {single_duration / duration:5.2f}')
+
+
+def parse_args():
+    """Parse command line arguments.
+
+    Returns:
+        argparse.Namespace: Command line arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--user', default='postgres')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5432)
+    parser.add_argument('--database', default='bearing_load_test',
+                        help='stand-in database, not production bearing_db')
+    parser.add_argument('--setup', action='store_true',
+                        help='create synthetic tables and exit')
+    parser.add_argument('--force', action='store_true',
+                        help='replace existing tables on --setup')
+    parser.add_argument('--data-days', type=int, default=365,
+                        help='days of synthetic data')
+    parser.add_argument('-n', '--analysts', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='numbers of concurrent analysts to test')
+    parser.add_argument('--analysts-per-workstation', type=int, default=1,
+                        help='analyst threads sharing one connection pool, '
+                             'pool contention shows only above --pool-size')
+    parser.add_argument('--pool-size', type=int, default=20,
+                        help='connections in pool of every workstation')
+    parser.add_argument('--requests', type=int, default=10,
+                        help='forecasts per analyst')
+    parser.add_argument('--range-days', type=int, default=1,
+                        help='days in forecast range')
+    parser.add_argument('--synthetic-models', action='store_true',
+                        help='fit models on random data instead of loading')
+    parser.add_argument('--sharding-benchmark', action='store_true',
+                        help='time sharded inference and exit')
+    parser.add_argument('--benchmark-rows', type=int, default=100000,
+                        help='rows of predictor matrix in benchmark')
+    parser.add_argument('--benchmark-processes', type=int, nargs='+',
+                        default=[1, 2, 4],
+                        help='numbers of worker processes in benchmark')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.setup:
+        setup_database(arguments)
+    elif arguments.sharding_benchmark:
+        run_sharding_benchmark(arguments)
+    else:
+        for count in arguments.analysts:
+            run_level(arguments, count)
@@ -1,13 +1,12 @@
 """Bearing Vibration Prediction Information System"""
 from datetime import datetime, timedelta
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Tuple
 import socket
 import wx
 import wx.adv
 from wx.lib import buttons
 import psycopg2 as pspg2
 from psycopg2 import pool
-import numpy as np
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from smtplib import SMTP
@@ -15,6 +14,9 @@ import ssl
 import matplotlib
 import pandas as pd
 import joblib
+import logging
+import bearing_data
+from bearing_data import BEARING_LIST
 from matplotlib.backends.backend_wxagg import (
     NavigationToolbar2WxAgg as NavigationToolbar,
     FigureCanvasWxAgg as FigureCanvas)
@@ -23,14 +25,13 @@ import seaborn as sns
 sns.set_theme()
 matplotlib.use('WXAgg')
 
-BEARING_LIST: List[str] = ['Первый подшипник',
-                           'Второй подшипник',
-                           'Третий подшипник']
 MAX_BEARINGS_VIBRATION: Dict[int, int] = {0: 96, 1: 33, 2: 52}
 BACKGROUND_COLOR: str = '#ffe2b0'
 BUTTON_COLOR: str = '#eab0bb'
 TEXT_COLOR: str = '#000d35'
 
+logger = logging.getLogger(__name__)
+
 
 class AuthorizationWindow(wx.Frame):
     """Window that allows user to enter Information System."""
@@ -116,7 +117,8 @@ class AuthorizationWindow(wx.Frame):
             psycopg2.OperationalError: If username or password is invalid.
         """
         try:
-            connection_pool = pool.SimpleConnectionPool(
+            # prefetch runs on background thread, so pool must be thread-safe
+            connection_pool = pool.ThreadedConnectionPool(
                 1, 20,
                 user=username,
                 password=password,
@@ -140,24 +142,37 @@ class AuthorizationWindow(wx.Frame):
             connection_pool = self.get_connection_pool(login, password)
             if connection_pool:
                 self.Destroy()
-                main_frame = MainWindow(connection_pool=connection_pool)
+                # score the most likely request while user opens dialog
+                prefetcher = bearing_data.Prefetcher(connection_pool)
+                prefetcher.prefetch_latest()
+                main_frame = MainWindow(connection_pool=connection_pool,
+                                        prefetcher=prefetcher)
                 main_frame.Show()
 
 
 class MainWindow(wx.Frame):
     """App main window."""
 
-    def __init__(self, connection_pool=None):
+    def __init__(self, connection_pool=None, prefetcher=None):
         """Create Main Window.
 
         Attributes:
-            connection_pool (psycopg2.pool.SimpleConnectionPool):\
+            connection_pool (psycopg2.pool.ThreadedConnectionPool):\
                 PostgreSQL connection pool.
+            prefetcher (bearing_data.Prefetcher):\
+                Background prefetch of likely forecast ranges.
             bearing_type (int): User's bearing choice.
             predictor_matrix (pd.DataFrame):\
-                DataFrame that stores input data for models.
+                DataFrame that stores scaled input data for models,\
+                released after prediction.
             predictions (pd.DataFrame):\
                 DataFrame that stores fitted values with confidence coridor.
+            coverage_indexes (Dict[int, bearing_data.CoverageIndex]):\
+                Existing data slots of every bearing table.
+            sharded_predictor (bearing_data.ShardedPredictor):\
+                Worker pool for large ranges, started on first use.
+            rss_monitor (bearing_data.RssMonitor):\
+                Peak RSS of fetch, scale and predict of last forecast.
         """
         super().__init__(parent=None,
                          title='Главное окно',
@@ -167,6 +182,8 @@ class MainWindow(wx.Frame):
         self.Center()
 
         self.connection_pool = connection_pool
+        self.prefetcher = prefetcher or bearing_data.Prefetcher(
+            connection_pool)
 
         panel = wx.Panel(self)
         panel.SetFont(APP_FONT)
@@ -188,6 +205,11 @@ class MainWindow(wx.Frame):
         self.bearing_type: int = -1
         self.predictor_matrix = None
         self.predictions = None
+        self.coverage_indexes: Dict[int, bearing_data.CoverageIndex] = {
+            bearing: bearing_data.CoverageIndex(bearing)
+            for bearing in range(len(BEARING_LIST))}
+        self.sharded_predictor = None
+        self.rss_monitor = None
 
         self.visualization_button = buttons.GenButton(
             panel, label='Визуализация процесса')
@@ -239,6 +261,9 @@ class MainWindow(wx.Frame):
         result = dialog_message.ShowModal()
 
         if result == wx.ID_YES:
+            self.prefetcher.close()
+            if self.sharded_predictor is not None:
+                self.sharded_predictor.close()
             self.connection_pool.closeall
             self.Destroy()
         else:
@@ -247,38 +272,50 @@ class MainWindow(wx.Frame):
     def on_select_button_click(self, event) -> None:
         """Open Select Data Window."""
         # bearing_type: int = self.bearing_choice.GetCurrentSelection()
+        predictions = self.predictions
+        # covers only fetch, scale and predict, not time spent in dialog
+        self.rss_monitor = bearing_data.RssMonitor()
         with SelectDataWindow(self,
-                              self.connection_pool) as select_data_dialog:
+                              self.connection_pool,
+                              self.coverage_indexes,
+                              self.prefetcher) as select_data_dialog:
             select_data_dialog.ShowModal()
         if self.predictor_matrix is not None:
+            with self.rss_monitor:
+                self.make_predictions()
+        if self.predictions is not predictions:
+            if self.rss_monitor.peak_rss:
+                logger.info('Forecast peak RSS: %.1f MB (%+.1f MB)',
+                            self.rss_monitor.peak_rss / 2**20,
+                            (self.rss_monitor.peak_rss
+                             - self.rss_monitor.start_rss) / 2**20)
+            else:
+                logger.info('Process peak RSS: %.1f MB',
+                            bearing_data.get_peak_rss() / 2**20)
+        if self.predictions is not None:
             # Enable buttons
             self.visualization_button.Enable(True)
             self.save_prediction_button.Enable(True)
-            # Make predictions
-            if self.bearing_type == 0:
-                model = joblib.load(r'models\final_model_1st.model')
-            elif self.bearing_type == 1:
-                model = joblib.load(r'models\final_model_2st.model')
-            elif self.bearing_type == 2:
-                model = joblib.load(r'models\final_model_3st.model')
-            forecast_values = model.predict(self.predictor_matrix)
-
-            min_forecast_values, max_forecast_values = self.\
-                prediction_intervals(forecast_values)
-            self.predictions = pd.DataFrame(
-                {'date': self.predictor_matrix.index,
-                 'value': forecast_values,
-                 'max_value': max_forecast_values,
-                 'min_value': min_forecast_values})
-
-    def prediction_intervals(self, y_r: np.ndarray) -> Tuple[
-            np.ndarray, np.ndarray]:
-        '''Prediction interval'''
-        std = y_r.std()
-        koef = 2.1701
-        yr_min = y_r - round(koef * std, 8)
-        yr_max = y_r + round(koef * std, 8)
-        return yr_min, yr_max
+
+    def make_predictions(self) -> None:
+        """Make predictions for predictor matrix and release it."""
+        model_path: str = bearing_data.MODEL_PATHS[self.bearing_type]
+        if len(self.predictor_matrix) >= bearing_data.SHARDED_INFERENCE_ROWS:
+            if self.sharded_predictor is None:
+                self.sharded_predictor = bearing_data.ShardedPredictor()
+            forecast_values = self.sharded_predictor.predict(
+                model_path, self.predictor_matrix)
+        else:
+            model = joblib.load(model_path)
+            bearing_data.check_feature_dtype(self.bearing_type,
+                                             model,
+                                             self.predictor_matrix)
+            forecast_values = bearing_data.predict_values(
+                model, self.predictor_matrix)
+        self.predictions = bearing_data.make_predictions(
+            self.predictor_matrix.index, forecast_values)
+        # predictor matrix is not needed after prediction
+        self.predictor_matrix = None
 
     def on_visualization_button_click(self, event) -> None:
         """Open Plot Window."""
@@ -296,16 +333,9 @@ class MainWindow(wx.Frame):
         """Save predictions to database."""
         if check_internet_connection():
             connection = self.connection_pool.getconn()
-            with connection.cursor() as cursor:
-                query: str = "CALL insert_predictions(%s, %s, %s);"
-                current_date = datetime.today()
-                report_date: str = current_date.strftime("%Y-%m-%d %H:%M:%S")
-                prediction = self.predictions.to_json(orient='records',
-                                                      date_format='iso')
-                parametrs: List[Any] = [
-                    BEARING_LIST[self.bearing_type], report_date, prediction]
-                cursor.execute(query, parametrs)
-                connection.commit()
+            bearing_data.save_predictions(connection,
+                                          self.bearing_type,
+                                          self.predictions)
             information_text: str = 'Прогнозы успешно загружены'
             information_message = wx.MessageDialog(
                 None,
@@ -319,27 +349,43 @@ class MainWindow(wx.Frame):
 class SelectDataWindow(wx.Dialog):
     """Window that allows to choose prediction date."""
 
-    def __init__(self, parent, connection_pool):
+    def __init__(self, parent, connection_pool, coverage_indexes,
+                 prefetcher):
         """Create Select Data Window.
 
         Attributes:
-            connection_pool (psycopg2.pool.SimpleConnectionPool):\
+            connection_pool (psycopg2.pool.ThreadedConnectionPool):\
                 PostgreSQL connection pool.
+            coverage_indexes (Dict[int, bearing_data.CoverageIndex]):\
+                Existing data slots of every bearing table.
+            prefetcher (bearing_data.Prefetcher):\
+                Background prefetch of likely forecast ranges.
             bearing (str): User's bearing choice.
             parent : Parent window reference.
             date_begin_edit (wx.adv.DatePickerCtrl):\
                 Control that contains first prediction date.
             date_end_edit (wx.adv.DatePickerCtrl):\
                 Control that contains second prediction date.
+            coverage_label (wx.StaticText):\
+                Label that shows data availability for chosen dates.
         """
         super().__init__(parent=parent,
                          title='Выбрать дату прогноза',
-                         size=(300, 220),
+                         size=(300, 250),
                          style=wx.MINIMIZE_BOX | wx.SYSTEM_MENU
                          | wx.CAPTION | wx.CLOSE_BOX)
         self.Center()
         self.connection_pool = connection_pool
+        self.coverage_indexes = coverage_indexes
+        self.prefetcher = prefetcher
         self.parent = parent
+        # bring coverage up to date with rows added since last time
+        connection = self.connection_pool.getconn()
+        try:
+            for coverage_index in self.coverage_indexes.values():
+                coverage_index.update(connection)
+        finally:
+            self.connection_pool.putconn(connection)
 
         panel = wx.Panel(self)
         panel.SetFont(APP_FONT)
@@ -357,6 +403,9 @@ class SelectDataWindow(wx.Dialog):
         self.date_begin_edit = wx.adv.DatePickerCtrl(panel,
                                                      style=wx.adv.DP_DROPDOWN,
                                                      size=(230, 30))
+        # the most recent day is prefetched after login
+        self.date_begin_edit.SetValue(
+            wx.DateTime.Today().Subtract(wx.DateSpan.Day()))
 
         date_end_label = wx.StaticText(panel, label='По')
         date_end_label.SetForegroundColour(TEXT_COLOR)
@@ -374,6 +423,17 @@ class SelectDataWindow(wx.Dialog):
         box_sizer = wx.BoxSizer(wx.VERTICAL)
         box_sizer.Add(flex_grid_sizer, flag=wx.EXPAND | wx.ALL, border=10)
 
+        self.coverage_label = wx.StaticText(panel)
+        self.coverage_label.SetForegroundColour(TEXT_COLOR)
+        box_sizer.Add(self.coverage_label,
+                      flag=wx.EXPAND | wx.LEFT | wx.RIGHT | wx.BOTTOM,
+                      border=10)
+        self.bearing_choice.Bind(wx.EVT_CHOICE, self.on_selection_change)
+        self.date_begin_edit.Bind(wx.adv.EVT_DATE_CHANGED,
+                                  self.on_selection_change)
+        self.date_end_edit.Bind(wx.adv.EVT_DATE_CHANGED,
+                                self.on_selection_change)
+
         enter_button = buttons.GenButton(panel, label='Спрогнозировать')
         enter_button.SetForegroundColour(TEXT_COLOR)
         enter_button.SetBackgroundColour(BUTTON_COLOR)
@@ -382,85 +442,190 @@ class SelectDataWindow(wx.Dialog):
         enter_button.Bind(wx.EVT_BUTTON, self.on_enter_button_click)
         panel.SetSizer(box_sizer)
 
-    def on_enter_button_click(self, event) -> None:
-        """Select data from DB and send it to Main Window."""
+        self.show_coverage()
+
+    def get_dates(self) -> Tuple[datetime, datetime]:
+        """Get chosen prediction dates.
+
+        Returns:
+            Tuple[datetime.datetime, datetime.datetime]:\
+                First and second prediction dates.
+        """
         date_begin: str = str(self.date_begin_edit.GetValue()).split()[1]
         date_end: str = str(self.date_end_edit.GetValue()).split()[1]
 
         # formatting date to PostgreSQL timestamp type
         date_begin = datetime(*list(map(int, date_begin.split('.')))[::-1])
         date_end = datetime(*list(map(int, date_end.split('.')))[::-1])
+        return date_begin, date_end
 
+    def on_selection_change(self, event) -> None:
+        """Update data availability label and prefetch chosen range."""
+        self.show_coverage()
+        date_begin, date_end = self.get_dates()
         bearing: int = self.bearing_choice.GetCurrentSelection()
+        if date_begin < date_end and self.coverage_indexes[
+                bearing].count_slots(date_begin, date_end) > 0:
+            self.prefetcher.prefetch((bearing, date_begin, date_end),
+                                     exclusive=True)
+
+    def show_coverage(self) -> None:
+        """Show how many 10-minute slots of chosen range have data."""
+        date_begin, date_end = self.get_dates()
+        if date_begin >= date_end:
+            self.coverage_label.SetLabel('')
+            return
+        coverage_index = self.coverage_indexes[
+            self.bearing_choice.GetCurrentSelection()]
+        slot_count: int = coverage_index.count_slots(date_begin, date_end)
+        max_slot_count: int = (date_end - date_begin) \
+            // bearing_data.DATA_INTERVAL
+        gap_count: int = len(coverage_index.get_gaps(date_begin, date_end))
+        self.coverage_label.SetLabel(
+            f'Есть данные: {slot_count} из {max_slot_count}, '
+            f'пропусков: {gap_count}')
+
+    def on_enter_button_click(self, event) -> None:
+        """Select data from DB and send it to Main Window."""
+        date_begin, date_end = self.get_dates()
 
-        if self.check_date(date_begin, date_end):
-            parameters: Tuple[str] = (date_begin, date_end)
-            if bearing == 0:
-                query: str = "SELECT * FROM X1 \
-                    WHERE date_time >= %s AND date_time < %s"
-                column_count: int = 16
-            elif bearing == 1:
-                query: str = "SELECT * FROM X2 \
-                    WHERE date_time >= %s AND date_time < %s"
-                column_count: int = 18
-            elif bearing == 2:
-                query: str = "SELECT * FROM X3 \
-                    WHERE date_time >= %s AND date_time < %s"
-                column_count: int = 18
+        bearing: int = self.bearing_choice.GetCurrentSelection()
 
+        if not self.check_date(date_begin, date_end):
+            return
+        coverage_index = self.coverage_indexes[bearing]
+        if coverage_index.count_slots(date_begin, date_end) == 0:
+            # rows inserted before watermark are not indexed yet,
+            # so check the range itself before giving up
             connection = self.connection_pool.getconn()
-            with connection.cursor() as cursor:
-                cursor.execute(query, parameters)
-                predictor_matrix = cursor.fetchall()
-                predictor_matrix = pd.DataFrame(
-                    data=predictor_matrix,
-                    columns=['col ' + str(i)
-                             for i in range(column_count)])
-                if predictor_matrix.empty:
-                    error_text: str = 'Нет данных на эти даты.'
-                    error_message = wx.MessageDialog(None,
-                                                     error_text,
-                                                     ' ',
-                                                     wx.OK | wx.ICON_ERROR)
-                    error_message.ShowModal()
-                else:
-                    predictor_matrix.index = predictor_matrix.iloc[:, 0]
-                    predictor_matrix = predictor_matrix.drop(
-                        columns=['col 0'], axis=1)
-
-                    query_last_date = predictor_matrix.index[-1]\
-                        .to_pydatetime()
-                    if date_end - timedelta(minutes=10) > query_last_date:
-                        warning_text: str = f'Последние данные есть\
- за {query_last_date}.'
-                        warning_message = wx.MessageDialog(
-                            None,
-                            warning_text,
-                            ' ',
-                            wx.OK | wx.ICON_INFORMATION)
-                        warning_message.ShowModal()
-                    elif date_end - timedelta(minutes=10) == query_last_date:
-                        information_text: str = 'Данные успешно получены'
-                        information_message = wx.MessageDialog(
-                            None,
-                            information_text,
-                            ' ',
-                            wx.OK | wx.ICON_INFORMATION)
-                        information_message.ShowModal()
-
-                    if bearing == 0:
-                        scaler = joblib.load(r'scalers\scaler1st.model')
-                    elif bearing == 1:
-                        scaler = joblib.load(r'scalers\scaler2st.model')
-                    elif bearing == 2:
-                        scaler = joblib.load(r'scalers\scaler3st.model')
-                predictor_matrix = pd.DataFrame(
-                    data=scaler.transform(predictor_matrix),
-                    columns=predictor_matrix.columns,
-                    index=predictor_matrix.index)
-                self.parent.bearing_type = bearing
-                self.parent.predictor_matrix = predictor_matrix
+            try:
+                coverage_index.refresh(connection, date_begin, date_end)
+            finally:
                 self.connection_pool.putconn(connection)
+            if coverage_index.count_slots(date_begin, date_end) == 0:
+                # skip query, there is nothing to fetch
+                self.show_no_data()
+                return
+
+        predictor_matrix = None
+        with self.parent.rss_monitor:
+            predictions = self.prefetcher.get(
+                (bearing, date_begin, date_end))
+            logger.info('Prefetch hits: %d of %d (%.0f%%)',
+                        self.prefetcher.hits, self.prefetcher.requests,
+                        100 * self.prefetcher.hit_rate)
+            if predictions is None:
+                predictor_matrix, predictions = self.fetch_data(
+                    bearing, date_begin, date_end)
+        if predictions is None and predictor_matrix is None:
+            self.show_no_data()
+            return
+
+        if predictor_matrix is not None:
+            dates = predictor_matrix.index
+        else:
+            dates = pd.DatetimeIndex(predictions['date'])
+        # fetched rows fix slots that index has missed
+        coverage_index.add_dates(dates)
+        self.show_gaps(coverage_index, date_begin, date_end)
+        self.show_last_date(dates[-1].to_pydatetime(), date_end)
+
+        self.parent.bearing_type = bearing
+        if predictor_matrix is not None:
+            self.parent.predictor_matrix = predictor_matrix
+        else:
+            self.parent.predictions = predictions
+
+    def fetch_data(self, bearing: int, date_begin, date_end) -> Tuple[
+            Any, Any]:
+        """Fetch and scale data, or predict it chunk by chunk if it is big.
+
+        Args:
+            bearing (int): Bearing type.
+            date_begin (datetime.datetime): First prediction date.
+            date_end (datetime.datetime): Second prediction date.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: Scaled predictor matrix\
+                or predictions, both None if there is no data.
+        """
+        scaler = joblib.load(bearing_data.SCALER_PATHS[bearing])
+        connection = self.connection_pool.getconn()
+        try:
+            if not bearing_data.fits_memory_budget(bearing,
+                                                   date_begin, date_end):
+                # matrix is too big, predict it chunk by chunk right here
+                model = joblib.load(bearing_data.MODEL_PATHS[bearing])
+                return None, bearing_data.forecast_in_chunks(
+                    connection, bearing, date_begin, date_end,
+                    scaler, model)
+            predictor_matrix = bearing_data.fetch_predictor_matrix(
+                connection, bearing, date_begin, date_end)
+        finally:
+            self.connection_pool.putconn(connection)
+        if predictor_matrix.empty:
+            return None, None
+        predictor_matrix = bearing_data.scale_predictor_matrix(
+            scaler, predictor_matrix,
+            bearing_data.get_feature_dtype(bearing))
+        return predictor_matrix, None
+
+    def show_gaps(self, coverage_index, date_begin, date_end) -> None:
+        """Warn about gaps inside prediction range.
+
+        Args:
+            coverage_index (bearing_data.CoverageIndex):\
+                Existing data slots of chosen bearing.
+            date_begin (datetime.datetime): First prediction date.
+            date_end (datetime.datetime): Second prediction date.
+        """
+        gaps = coverage_index.get_gaps(date_begin, date_end)
+        # gap at the end of range is reported by last date warning
+        internal_gaps = [gap for gap in gaps if gap[1] < date_end]
+        if internal_gaps:
+            gap_begin, gap_end = internal_gaps[0]
+            warning_text: str = f'В данных есть пропуски\
+ ({len(internal_gaps)}), первый с {gap_begin} по {gap_end}.'
+            warning_message = wx.MessageDialog(
+                None,
+                warning_text,
+                ' ',
+                wx.OK | wx.ICON_WARNING)
+            warning_message.ShowModal()
+
+    def show_no_data(self) -> None:
+        """Show no data error dialog."""
+        error_text: str = 'Нет данных на эти даты.'
+        error_message = wx.MessageDialog(None,
+                                         error_text,
+                                         ' ',
+                                         wx.OK | wx.ICON_ERROR)
+        error_message.ShowModal()
+
+    def show_last_date(self, query_last_date, date_end) -> None:
+        """Show whether data reaches the end of prediction range.
+
+        Args:
+            query_last_date (datetime.datetime): Last date with data.
+            date_end (datetime.datetime): Second prediction date.
+        """
+        if date_end - timedelta(minutes=10) > query_last_date:
+            warning_text: str = f'Последние данные есть\
+ за {query_last_date}.'
+            warning_message = wx.MessageDialog(
+                None,
+                warning_text,
+                ' ',
+                wx.OK | wx.ICON_INFORMATION)
+            warning_message.ShowModal()
+        elif date_end - timedelta(minutes=10) == query_last_date:
+            information_text: str = 'Данные успешно получены'
+            information_message = wx.MessageDialog(
+                None,
+                information_text,
+                ' ',
+                wx.OK | wx.ICON_INFORMATION)
+            information_message.ShowModal()
 
     def check_date(self, date_begin, date_end) -> bool:
         """Check date for validity.
@@ -746,6 +911,11 @@ def check_internet_connection() -> bool:
 
 
 if __name__ == '__main__':
+    # there is no console under pythonw, so log to file
+    logging.basicConfig(filename='forecast.log',
+                        level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s: '
+                               '%(message)s')
     app = wx.App()
     # get OS default font
     APP_FONT = wx.SystemSettings.GetFont(wx.SYS_DEFAULT_GUI_FONT)